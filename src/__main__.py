@@ -1,22 +1,31 @@
 import os
 import re
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 
 import requests
 from dotenv import load_dotenv
 
 from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from pyairtable import Api
 
+from src.checkpoints import CheckpointStore
+from src.coordination import Coordinator, LeaseError
+from src.file_relay import FileRelay
+from src.memory_budget import MemoryBudget, approx_size, get_rss_bytes
+from src.parallel import executor, listener_executor, queue_bytes, run_parallel
+from src.shutdown import ShutdownCoordinator
+from src.startup import BufferedSocketModeHandler
 from src.thread_manager import ThreadManager
 
 load_dotenv()
 
 # Slack setup
-app = App(token=os.getenv("SLACK_BOT_TOKEN"))
+app = App(token=os.getenv("SLACK_BOT_TOKEN"), listener_executor=listener_executor)
 client = WebClient(token=os.getenv("SLACK_BOT_TOKEN"))
 user_client = WebClient(token=os.getenv("SLACK_USER_TOKEN"))
 
@@ -26,8 +35,126 @@ CHANNEL = os.getenv("CHANNEL_ID")
 airtable_api = Api(os.getenv("AIRTABLE_API_KEY"))
 airtable_base = airtable_api.base(os.getenv("AIRTABLE_BASE_ID"))
 
-# Thread stuff
-thread_manager = ThreadManager(airtable_base)
+# Replicas share leases and cache invalidations through this db, without it we are on our own
+coordinator = Coordinator(os.getenv("COORDINATION_DB") or None)
+
+# Thread stuff, loaded in the background once the bot starts
+thread_manager = ThreadManager(airtable_base, coordinator, load=False)
+handler = None
+
+# SIGTERM drains the bot, unfinished long jobs are saved here and picked up by the next process
+shutdown = ShutdownCoordinator(int(os.getenv("SHUTDOWN_DEADLINE") or "25"))
+checkpoints = CheckpointStore(os.getenv("CHECKPOINT_DIR") or "data/checkpoints")
+CHECKPOINT_CLAIM_INTERVAL = 60
+coordinator.listen(thread_manager.refresh_user)
+
+# Parent posts carry their user in message metadata, so replies can be routed without the cache
+THREAD_METADATA_TYPE = "certpheus_thread"
+THREAD_OWNERS_LIMIT = 1000
+thread_owners = OrderedDict()
+thread_owners_lock = threading.Lock()
+
+
+# Memory stuff, the container has 512MB so keep caches below that
+memory_budget = MemoryBudget(
+    int(os.getenv("MEMORY_BUDGET_MB") or "384") * 1024 * 1024,
+    rss_limit_bytes=int(os.getenv("MEMORY_LIMIT_MB") or "512") * 1024 * 1024
+)
+
+# Files go through a temp file in chunks of this size, the container has way more disk than memory
+FILE_CHUNK_BYTES = 1024 * 1024
+
+
+def evict_thread_owners(bytes_to_free):
+    """Forget oldest thread owners, they can be fetched again from parent's metadata"""
+    freed = 0
+    with thread_owners_lock:
+        while thread_owners and freed < bytes_to_free:
+            thread_ts, user_id = thread_owners.popitem(last=False)
+            freed += approx_size(thread_ts) + approx_size(user_id)
+    return freed
+
+def thread_owners_size():
+    with thread_owners_lock:
+        return approx_size(thread_owners)
+
+memory_budget.register("thread_owners", thread_owners_size, evict_thread_owners, priority=0)
+memory_budget.register("completed_cache", thread_manager.completed_cache_size, thread_manager.evict_completed, priority=1)
+memory_budget.register("active_cache", thread_manager.active_cache_size)
+memory_budget.register("executor_queue", queue_bytes)
+memory_budget.register("listener_queue", lambda: queue_bytes(listener_executor))
+memory_budget.register("pending_activity", thread_manager.pending_activity_size)
+memory_budget.register("local_locks", coordinator.local_locks_size)
+memory_budget.start()
+
+
+def get_thread_metadata(user_id):
+    """Get metadata attached to the parent message of a user's thread"""
+    return {
+        "event_type": THREAD_METADATA_TYPE,
+        "event_payload": {
+            "user_id": user_id
+        }
+    }
+
+def remember_thread_owner(thread_ts, user_id):
+    """Keep thread_ts -> user_id mapping around (None when the parent has no metadata), oldest ones get dropped"""
+    with thread_owners_lock:
+        thread_owners[thread_ts] = user_id
+        thread_owners.move_to_end(thread_ts)
+        while len(thread_owners) > THREAD_OWNERS_LIMIT:
+            thread_owners.popitem(last=False)
+
+def get_user_from_metadata(message):
+    """Read user_id out of our metadata, if the message has it"""
+    metadata = message.get("metadata") or {}
+    if metadata.get("event_type") != THREAD_METADATA_TYPE:
+        return None
+
+    return (metadata.get("event_payload") or {}).get("user_id")
+
+def resolve_thread_user(thread_ts, event=None):
+    """Find the user a channel thread belongs to"""
+    # Payload first, it's free
+    if event:
+        user_id = get_user_from_metadata(event)
+        if user_id:
+            remember_thread_owner(thread_ts, user_id)
+            return user_id
+
+    # Already looked at that parent before, None means it had no metadata
+    with thread_owners_lock:
+        known = thread_ts in thread_owners
+        if known:
+            thread_owners.move_to_end(thread_ts)
+            user_id = thread_owners[thread_ts]
+
+    if not known:
+        # Fetch the parent message once, with its metadata
+        try:
+            response = client.conversations_history(
+                channel=CHANNEL,
+                latest=thread_ts,
+                inclusive=True,
+                limit=1,
+                include_all_metadata=True
+            )
+            messages = response.get("messages", [])
+            user_id = None
+            if messages and messages[0].get("ts") == thread_ts:
+                user_id = get_user_from_metadata(messages[0])
+            remember_thread_owner(thread_ts, user_id)
+
+        except SlackApiError as err:
+            # Not remembered, next reply tries again
+            print(f"Error fetching parent message of {thread_ts}: {err}")
+            user_id = None
+
+    if user_id:
+        return user_id
+
+    # Legacy threads made before metadata existed, the active cache knows their owner while they are open
+    return thread_manager.find_user_by_thread(thread_ts)
 
 
 def get_standard_channel_msg(user_id, message_text):
@@ -119,34 +246,38 @@ def get_user_info(user_id):
 
 def post_message_to_channel(user_id, message_text, user_info, files=None):
     """Post user's message to the given channel, either as new message or new reply"""
-    # Add file info into the message
-    # if files:
-    #    message_text += format_files_for_message(files)
-
     # Slack is kinda weird and must have message text even when only file is shared
     if not message_text or message_text.strip() == "":
-        return None
+        if not files:
+            return None
+        message_text = ""
 
-    file_yes = False
-    if message_text == "":
-        file_yes = True
+    # No thread yet - create one, but only if nobody else (another replica too) did it meanwhile
+    if not thread_manager.has_active_thread(user_id):
+        try:
+            with coordinator.user_lease(user_id):
+                if not thread_manager.has_active_thread(user_id):
+                    return create_new_thread(user_id, message_text or "_Shared a file_", user_info, files)
+        except LeaseError as err:
+            print(f"Error creating thread for {user_id}: {err}")
+            return False
 
     # Try uploading stuff into an old thread
     if thread_manager.has_active_thread(user_id):
         thread_info = thread_manager.get_active_thread(user_id)
 
         try:
-            response = client.chat_postMessage(
-                channel=CHANNEL,
-                thread_ts=thread_info["thread_ts"],
-                text=f"{message_text}",
-                username=user_info["display_name"],
-                icon_url=user_info["avatar"]
-            )
+            if message_text:
+                client.chat_postMessage(
+                    channel=CHANNEL,
+                    thread_ts=thread_info["thread_ts"],
+                    text=f"{message_text}",
+                    username=user_info["display_name"],
+                    icon_url=user_info["avatar"]
+                )
 
             # Remember to upload files if they exist!
-            # Temp v2
-            if file_yes and files: #and message_text.strip() != "" and message_text == "[Shared file]":
+            if files:
                 download_reupload_files(files, CHANNEL, thread_info["thread_ts"])
 
             thread_manager.update_thread_activity(user_id)
@@ -155,9 +286,6 @@ def post_message_to_channel(user_id, message_text, user_info, files=None):
         except SlackApiError as err:
             print(f"Error writing to a thread: {err}")
             return False
-    # Create a new thread
-    else:
-        return create_new_thread(user_id, message_text, user_info)
 
 def create_new_thread(user_id, message_text, user_info, files=None):
     """Create new thread in the channel"""
@@ -172,8 +300,10 @@ def create_new_thread(user_id, message_text, user_info, files=None):
             text=f"*{user_id}*:\n{message_text}",
             username=user_info["display_name"],
             icon_url=user_info["avatar"],
-            blocks=get_standard_channel_msg(user_id, message_text)
+            blocks=get_standard_channel_msg(user_id, message_text),
+            metadata=get_thread_metadata(user_id)
         )
+        remember_thread_owner(response["ts"], user_id)
 
         # Upload files if they exist!
         if files:
@@ -207,17 +337,17 @@ def send_dm_to_user(user_id, reply_text, files=None):
         #    else:
         #        reply_text = "[Empty message]"
 
-        # Message them
-        client.chat_postMessage(
-            channel=dm_channel,
-            text=reply_text,
-            username="Certpheus",
-            icon_url="https://hc-cdn.hel1.your-objectstorage.com/s/v3/1807d070b4fadf5884893855a00b542a1acc1aca_image.png"
-        )
+        # Message them, file-only replies don't need any text
+        if reply_text:
+            client.chat_postMessage(
+                channel=dm_channel,
+                text=reply_text,
+                username="Certpheus",
+                icon_url="https://hc-cdn.hel1.your-objectstorage.com/s/v3/1807d070b4fadf5884893855a00b542a1acc1aca_image.png"
+            )
 
         # Upload files if they are there
-        # Temp v2
-        if files and reply_text == "":
+        if files:
             download_reupload_files(files, dm_channel)
 
         return True
@@ -291,83 +421,259 @@ def handle_fdchat_cmd(ack, respond, command):
         })
         return
 
-    # Check if user has an active thread, if so - use it
-    if thread_manager.has_active_thread(target_user_id):
-        thread_info = thread_manager.get_active_thread(target_user_id)
+    # Only one replica at a time can decide whether this user needs a new thread
+    try:
+        with coordinator.user_lease(target_user_id):
+            # Check if user has an active thread, if so - use it
+            if thread_manager.has_active_thread(target_user_id):
+                thread_info = thread_manager.get_active_thread(target_user_id)
+
+                # None of these depend on each other, do them all at once
+                results = run_parallel(
+                    channel_post=lambda: client.chat_postMessage(
+                        channel=CHANNEL,
+                        thread_ts=thread_info["thread_ts"],
+                        text=f"*<@{requester_id}> continued:*\n{staff_message}"
+                    ),
+                    dm=lambda: send_dm_to_user(target_user_id, staff_message)
+                )
+                thread_manager.update_thread_activity(target_user_id)
+
+                # Some nice logs for clarity, both steps ran so say how each one went
+                dm_sent = results["dm"].ok and results["dm"].value
+                posted = results["channel_post"].ok
+
+                if dm_sent:
+                    thread_manager.record_staff_reply(thread_info["thread_ts"])
+
+                if dm_sent and posted:
+                    text = f"Message sent in some older thread to {user_info['display_name']}"
+                elif dm_sent:
+                    text = (f"Message delivered to {user_info['display_name']}, but the copy in the thread failed - "
+                            f"don't send it again")
+                elif posted:
+                    text = f"It sucks, couldn't DM {user_info['display_name']} - the message is only in the thread"
+                else:
+                    text = f"Something broke, awesome - neither the DM nor the thread message went through"
 
-        try:
-            client.chat_postMessage(
-                channel=CHANNEL,
-                thread_ts=thread_info["thread_ts"],
-                text=f"*<@{requester_id}> continued:*\n{staff_message}"
-            )
-            success = send_dm_to_user(target_user_id, staff_message)
-            thread_manager.update_thread_activity(target_user_id)
+                respond({
+                    "response_type": "ephemeral",
+                    "text": text
+                })
+                return
+            # Try to create a new thread (Try, not trying. It was standing out a lot, I had to fix it a little)
+            try:
+                success = send_dm_to_user(target_user_id, staff_message)
+                if not success:
+                    respond({
+                        "response_type": "ephemeral",
+                        "text": f"Failed to send DM to {target_user_id}"
+                    })
+                    return
+
+                staff_message = f"*<@{requester_id}> started a message to <@{target_user_id}>:*\n" + staff_message
+
+                response = client.chat_postMessage(
+                    channel=CHANNEL,
+                    text=f"*<@{user_id}> started a message to <@{target_user_id}>:*\n {staff_message}",
+                    username=user_info["display_name"],
+                    icon_url=user_info["avatar"],
+                    blocks=get_standard_channel_msg(target_user_id, staff_message),
+                    metadata=get_thread_metadata(target_user_id)
+                )
+                remember_thread_owner(response["ts"], target_user_id)
+
+                # Track the thread, staff started it so nobody is waiting for a response
+                thread_manager.create_active_thread(
+                    target_user_id,
+                    CHANNEL,
+                    response["ts"],
+                    response["ts"],
+                    awaiting_response=False
+                )
 
-            # Some nice logs for clarity
-            if success:
                 respond({
                     "response_type": "ephemeral",
-                    "text": f"Message sent in some older thread to {user_info['display_name']}"
+                    "text": f"Started conversation with {user_info['display_name']}, good luck"
                 })
-            else:
+
+                print(f"Successfully started conversation with {target_user_id} via slash command")
+
+            except SlackApiError as err:
                 respond({
                     "response_type": "ephemeral",
-                    "text": f"It sucks, couldn't add a message to older thread for {user_info['display_name']}"
+                    "text": f"Error starting conversation: {err}"
                 })
-            return
-        except SlackApiError as err:
-            respond({
-                "response_type": "ephemeral",
-                "text": f"Something broke, awesome - couldn't add a message to an existing thread"
-            })
-            return
-    # Try to create a new thread (Try, not trying. It was standing out a lot, I had to fix it a little)
-    try:
-        success = send_dm_to_user(target_user_id, staff_message)
-        if not success:
-            respond({
-                "response_type": "ephemeral",
-                "text": f"Failed to send DM to {target_user_id}"
-            })
-            return
+    except LeaseError:
+        respond({
+            "response_type": "ephemeral",
+            "text": f"Someone else is busy with this user right now, try again in a bit"
+        })
 
-        staff_message = f"*<@{requester_id}> started a message to <@{target_user_id}>:*\n" + staff_message
+def format_bytes(size):
+    """Bytes into something readable"""
+    if size > 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f}MB"
+    elif size > 1024:
+        return f"{size / 1024:.1f}KB"
+    return f"{size}B"
+
+@app.command("/certmem")
+def handle_certmem_cmd(ack, respond, command):
+    """Show memory usage of caches, '/certmem trace' also shows top allocations"""
+    ack()
 
-        response = client.chat_postMessage(
-            channel=CHANNEL,
-            text=f"*<@{user_id}> started a message to <@{target_user_id}>:*\n {staff_message}",
-            username=user_info["display_name"],
-            icon_url=user_info["avatar"],
-            blocks=get_standard_channel_msg(target_user_id, staff_message)
-        )
+    if command.get("channel_id") != CHANNEL:
+        respond({
+            "response_type": "ephemeral",
+            "text": f"This command can only be used in one place. If you don't know it, don't even try"
+        })
+        return
 
-        # Track the thread
-        thread_manager.create_active_thread(
-            target_user_id,
-            CHANNEL,
-            response["ts"],
-            response["ts"]
+    usage = memory_budget.usage()
+    lines = [f"*Memory budget:* {format_bytes(sum(usage.values()))} / {format_bytes(memory_budget.limit_bytes)}"]
+    rss = get_rss_bytes()
+    if rss is not None:
+        lines.append(f"*Process RSS:* {format_bytes(rss)}")
+    for name, size in sorted(usage.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"• `{name}`: {format_bytes(size)}")
+
+    if command.get("text", "").strip() == "trace":
+        top = memory_budget.snapshot()
+        if top is None:
+            lines.append("Allocation tracing started, run `/certmem trace` again in a bit")
+        else:
+            lines.append("*Top allocations:*")
+            for location, size, count in top:
+                lines.append(f"• `{location}`: {format_bytes(size)} ({count} blocks)")
+
+    respond({
+        "response_type": "ephemeral",
+        "text": "\n".join(lines)
+    })
+
+def format_duration(seconds):
+    """Seconds into something readable"""
+    if seconds == float("inf"):
+        return "over a week"
+    elif seconds >= 3600:
+        return f"{seconds / 3600:g}h"
+    return f"{seconds / 60:g}min"
+
+@app.command("/certstats")
+def handle_certstats_cmd(ack, respond, command):
+    """Show queue health, straight from the aggregates kept by thread manager"""
+    ack()
+
+    if command.get("channel_id") != CHANNEL:
+        respond({
+            "response_type": "ephemeral",
+            "text": f"This command can only be used in one place. If you don't know it, don't even try"
+        })
+        return
+
+    stats = thread_manager.stats.summary()
+
+    median = stats["median_response"]
+    if median is None:
+        median_text = "no data yet"
+    else:
+        median_text = f"under {format_duration(median)} ({stats['responses_measured']} threads measured)"
+
+    lines = [
+        f"*Open threads:* {stats['open_threads']} ({stats['awaiting_response']} waiting for the first response)",
+        f"*Median first response:* {median_text}",
+        "*Completed per day:*"
+    ]
+    for day, count in stats["completed_per_day"]:
+        lines.append(f"• {day}: {count}")
+
+    lines.append("*Busiest users:*")
+    for user_id, count in stats["busiest_users"]:
+        lines.append(f"• <@{user_id}>: {count} threads")
+
+    if handler and handler.metrics["ready_after"] is not None:
+        metrics = handler.metrics
+        lines.append(
+            f"*Startup:* ready after {metrics['ready_after']:.1f}s, {metrics['buffered']} events buffered "
+            f"(max wait {metrics['max_wait']:.1f}s), {metrics['dropped']} left for Slack to retry"
         )
 
+    respond({
+        "response_type": "ephemeral",
+        "text": "\n".join(lines)
+    })
+
+HISTORY_PAGE_SIZE = 10
+
+@app.command("/certhistory")
+def handle_certhistory_cmd(ack, respond, command):
+    """Show user's past threads, newest first: '/certhistory @user [page]'"""
+    ack()
+
+    if command.get("channel_id") != CHANNEL:
         respond({
             "response_type": "ephemeral",
-            "text": f"Started conversation with {user_info['display_name']}, good luck"
+            "text": f"This command can only be used in one place. If you don't know it, don't even try"
         })
+        return
 
-        print(f"Successfully started conversation with {target_user_id} via slash command")
+    parts = command.get("text", "").strip().split()
+    target_user_id = extract_user_id(parts[0]) if parts else None
+    if not target_user_id:
+        respond({
+            "response_type": "ephemeral",
+            "text": "Usage: '/certhistory @user [page]' or '/certhistory U000000 [page]'"
+        })
+        return
 
-    except SlackApiError as err:
+    page = max(int(parts[1]), 1) if len(parts) > 1 and parts[1].isdigit() else 1
+    threads, total = thread_manager.get_user_history(target_user_id, page, HISTORY_PAGE_SIZE)
+    if not threads:
         respond({
             "response_type": "ephemeral",
-            "text": f"Error starting conversation: {err}"
+            "text": f"No threads found for <@{target_user_id}>" + (f" on page {page}" if page > 1 else "")
         })
+        return
+
+    # Grab all permalinks at once
+    results = run_parallel(**{
+        str(i): (lambda thread=thread: client.chat_getPermalink(
+            channel=thread["channel"] or CHANNEL,
+            message_ts=thread["message_ts"]
+        )["permalink"])
+        for i, thread in enumerate(threads)
+    })
+
+    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    lines = [f"*Threads of <@{target_user_id}>* ({total} total, page {page}/{pages})"]
+    for i, thread in enumerate(threads):
+        started = time.strftime("%Y-%m-%d %H:%M", time.gmtime(float(thread["thread_ts"] or 0)))
+        status = "active" if thread["active"] else "completed"
+        result = results[str(i)]
+        if result.ok:
+            lines.append(f"• <{result.value}|{started}> - {status}")
+        else:
+            lines.append(f"• {started} - {status} (no permalink)")
+
+    if page < pages:
+        lines.append(f"Next page: `/certhistory {target_user_id} {page + 1}`")
+
+    respond({
+        "response_type": "ephemeral",
+        "text": "\n".join(lines)
+    })
 
 def handle_dms(user_id, message_text, files, say):
     print("recieved dm :)")
     """Receive and react to messages sent to the bot"""
     #if message_text and files:
     #    return
+    # Files which came with file_shared first are already on their way
+    files = file_relay.claim(files)
+    if not (message_text or "").strip() and not files:
+        return
+
     user_info = get_user_info(user_id)
     if not user_info:
         say("Hiya! Couldn't process your message, try again another time")
@@ -402,35 +708,31 @@ def handle_channel_reply(message, client):
     print("channel reply")
     """Handle replies in channel to send them to users"""
     thread_ts = message["thread_ts"]
-    reply_text = message["text"]
-    files = message.get("files", [])
+    reply_text = message.get("text") or ""
+    # Claim files even for notes, so file_shared won't relay them on its own
+    files = file_relay.claim(message.get("files", []))
     # Allow for notes (private messages between staff) if message isn't started with '!'
-    if not reply_text or (len(reply_text) > 0 and reply_text[0] != '!'):
+    # Files without any text go to the user as well
+    if reply_text and reply_text[0] != '!':
+        return
+    if not reply_text and not files:
         return
 
-    if reply_text[0] == '!':
+    if reply_text:
         reply_text = reply_text[1:]
 
-    #if reply_text and files:
-    #    return
-
-
-    # Find user's active thread by TS (look in cache -> look at TS)
-    target_user_id = None
-    for user_id in thread_manager.active_cache:
-        thread_info = thread_manager.get_active_thread(user_id)
-
-        # Check the TS
-        if thread_info and thread_info["thread_ts"] == thread_ts:
-            target_user_id = user_id
-            break
+    # Find the user from parent's metadata, or from the cache for older threads
+    target_user_id = resolve_thread_user(thread_ts, message)
 
     if target_user_id:
         success = send_dm_to_user(target_user_id, reply_text, files)
 
         # Some logging
         if success:
-            thread_manager.update_thread_activity(target_user_id)
+            thread_manager.record_staff_reply(thread_ts)
+            # Replies in older threads reach the user too, but they aren't activity of the current one
+            if thread_manager.is_active_thread(target_user_id, thread_ts):
+                thread_manager.update_thread_activity(target_user_id)
         else:
             print(f"Failed to send reply to user {target_user_id}")
             try:
@@ -445,6 +747,11 @@ def handle_channel_reply(message, client):
         print(f"Could not find user for thread {thread_ts}")
 
 
+def complete_thread_with_lease(user_id):
+    """Complete user's thread while holding their lease"""
+    with coordinator.user_lease(user_id):
+        return thread_manager.complete_thread(user_id)
+
 @app.action("mark_completed")
 def handle_mark_completed(ack, body, client):
     """Complete the thread"""
@@ -453,22 +760,23 @@ def handle_mark_completed(ack, body, client):
     user_id = body["actions"][0]["value"]
     messages_ts = body["message"]["ts"]
 
-    # Give a nice checkmark
-    try:
-        client.reactions_add(
+    # Give a nice checkmark and complete it in db, at the same time
+    results = run_parallel(
+        reaction=lambda: client.reactions_add(
             channel=CHANNEL,
             timestamp=messages_ts,
             name="white_check_mark"
-        )
+        ),
+        completion=lambda: complete_thread_with_lease(user_id)
+    )
 
-        success = thread_manager.complete_thread(user_id)
-        if success:
-            print(f"Marked thread for user {user_id} as completed")
-        else:
-            print(f"Failed to mark {user_id}'s thread as completed")
+    if not results["reaction"].ok:
+        print(f"Error adding checkmark to {user_id}'s thread: {results['reaction'].error}")
 
-    except SlackApiError as err:
-        print(f"Error marking thread as completed: {err}")
+    if results["completion"].ok and results["completion"].value:
+        print(f"Marked thread for user {user_id} as completed")
+    else:
+        print(f"Failed to mark {user_id}'s thread as completed")
 
 @app.action("delete_thread")
 def handle_delete_thread(ack, body, client):
@@ -485,8 +793,8 @@ def handle_delete_thread(ack, body, client):
         if user_id in thread_manager.active_cache and thread_manager.active_cache[user_id]["message_ts"] == message_ts:
             thread_info = thread_manager.active_cache[user_id]
         # Else, if he has a completed thread - get that info
-        elif user_id in thread_manager.completed_cache:
-            for i, thread in enumerate(thread_manager.completed_cache[user_id]):
+        else:
+            for thread in thread_manager.get_completed_threads(user_id):
                 if thread["message_ts"] == message_ts:
                     thread_info = thread
                     break
@@ -495,123 +803,224 @@ def handle_delete_thread(ack, body, client):
             print(f"Couldn't find thread info for {user_id} (messages ts {message_ts})")
             return
 
-        thread_ts = thread_info["thread_ts"]
+        delete_thread_job(user_id, message_ts, thread_info["thread_ts"])
 
-        # Try deleting
-        try:
-            # Going through some cursor stuff, cause of limits, grab 100 per iteration
-            cursor = None
-            while True:
-                api_args = {
-                    "channel": CHANNEL,
-                    "ts": thread_ts,
-                    "inclusive": True,
-                    "limit": 100
-                }
-
-                if cursor:
-                    api_args["cursor"] = cursor
+    except SlackApiError as err:
+        print(f"Error deleting thread: {err}")
 
-                # Get these messages
-                response = client.conversations_replies(**api_args)
-                messages = response["messages"]
+def delete_thread_job(user_id, message_ts, thread_ts):
+    """Delete every message of a thread and then the thread itself. On shutdown it stops and resumes next time"""
+    job_id = f"delete_thread:{message_ts}"
+    checkpoints.save(job_id, {
+        "type": "delete_thread",
+        "user_id": user_id,
+        "message_ts": message_ts,
+        "thread_ts": thread_ts
+    })
+
+    # Try deleting
+    try:
+        # Going through some cursor stuff, cause of limits, grab 100 per iteration
+        cursor = None
+        while True:
+            api_args = {
+                "channel": CHANNEL,
+                "ts": thread_ts,
+                "inclusive": True,
+                "limit": 100
+            }
 
-                # Go through every message, delete em. First as user (Admins can delete other people's messages)
-                # If that fails then as a bot
-                for message in messages:
+            if cursor:
+                api_args["cursor"] = cursor
+
+            # Get these messages
+            response = client.conversations_replies(**api_args)
+            messages = response["messages"]
+
+            # Go through every message, delete em. First as user (Admins can delete other people's messages)
+            # If that fails then as a bot
+            for message in messages:
+                # Deleted messages are gone for good, so the next process only has to do the rest
+                if shutdown.draining:
+                    print(f"Shutting down, thread {thread_ts} will be deleted by the next process")
+                    return False
+
+                try:
+                    user_client.chat_delete(
+                        channel=CHANNEL,
+                        ts=message["ts"],
+                        as_user=True
+                    )
+                    time.sleep(0.3)
+
+                except SlackApiError as err:
                     try:
-                        user_client.chat_delete(
+                        client.chat_delete(
                             channel=CHANNEL,
-                            ts=message["ts"],
-                            as_user=True
+                            ts=message["ts"]
                         )
                         time.sleep(0.3)
 
                     except SlackApiError as err:
-                        try:
-                            client.chat_delete(
-                                channel=CHANNEL,
-                                ts=message["ts"]
-                            )
-                            time.sleep(0.3)
-
-                        except SlackApiError as err:
-                            print(f"Couldn't delete messages {message['ts']}: {err}")
-                            time.sleep(0.2)
-                            continue
-
-                # If there are more messages, grab em
-                if response.get("has_more", False) and response.get("response_metadata", {}).get("next_cursor"):
-                    cursor = response["response_metadata"]["next_cursor"]
-                else:
-                    break
-
-        except SlackApiError as err:
-            print(f"Error deleting thread: {err}")
+                        print(f"Couldn't delete messages {message['ts']}: {err}")
+                        time.sleep(0.2)
+                        continue
 
-        thread_manager.delete_thread(user_id, message_ts)
+            # If there are more messages, grab em
+            if response.get("has_more", False) and response.get("response_metadata", {}).get("next_cursor"):
+                cursor = response["response_metadata"]["next_cursor"]
+            else:
+                break
 
     except SlackApiError as err:
         print(f"Error deleting thread: {err}")
 
-@app.event("file_shared")
-def handle_file_shared(event, client, logger):
-    """Handle files being shared"""
     try:
-        # ID of stuff
-        file_id = event["file_id"]
-        user_id = event["user_id"]
-        # Get that file info
-        file_info = client.files_info(file=file_id)
-        file_data = file_info["file"]
-
-        # Check if this is a DM
-        channels = file_data.get("channels", [])
-        groups = file_data.get("groups", [])
-        ims = file_data.get("ims", [])
-
-        #
-        #if groups and not file_data.get("initial_comment") and file_data.get("comments_count") == 0:
-        #    success = send_dm_to_user(user_id, "", files=[file_data])
-
-        # Warning, warning - this is a DM! Also don't process files with messages, they are handled elsewhere
-        if ims and not file_data.get("initial_comment") and file_data.get("comments_count") == 0:
-            user_info = get_user_info(user_id)
-            message_text = ""
-            if user_info:
-                success = post_message_to_channel(user_id, message_text, user_info, [file_data])
+        with coordinator.user_lease(user_id):
+            thread_manager.delete_thread(user_id, message_ts)
+    except LeaseError as err:
+        print(f"Error deleting thread from db: {err}")
+        return False
 
-                if not success:
-                    # Try to send an error message to the user, so he at least knows it failed...
-                    try:
-                        dm_response = client.conversations_open(users=user_id)
-                        dm_channel = dm_response["channel"]["id"]
-                        client.chat_postMessage(
-                            channel=dm_channel,
-                            type="ephemeral",
-                            username="Certpheus",
-                            icon_url="https://hc-cdn.hel1.your-objectstorage.com/s/v3/1807d070b4fadf5884893855a00b542a1acc1aca_image.png",
-                            text="*No luck for you, there was an issue processing your file*"
-                        )
+    checkpoints.remove(job_id)
+    return True
 
-                    except SlackApiError as err:
-                        print(f"Failed to send error msg: {err}")
+def drain_startup_buffer(time_left):
+    """Let buffered events run, the ones which can't make it are saved for the next process"""
+    if handler.wait_drained(time_left):
+        return True
+
+    leftover = handler.take_buffered()
+    for req in leftover:
+        checkpoints.save(f"event:{req.envelope_id}", {
+            "type": "socket_event",
+            "event_type": req.type,
+            "envelope_id": req.envelope_id,
+            "payload": req.payload
+        })
+    print(f"Saved {len(leftover)} buffered events for the next process")
+    return False
+
+def restore_saved_events(jobs):
+    """Events acked by a process which is gone but never handled go first into the startup buffer, in their order"""
+    for job_id, job in jobs.items():
+        if job.get("type") != "socket_event":
+            continue
+
+        print(f"Replaying {job_id}")
+        handler.restore(
+            job["event_type"],
+            job["envelope_id"],
+            job["payload"],
+            on_done=lambda ok, job_id=job_id: finish_replayed_event(job_id, ok)
+        )
 
-        # Message to the channel
-        elif groups and not file_data.get("initial_comment") and file_data.get("comments_count") == 0:
-            # Gosh that took a long time, grabbing the channel shares to get thread_ts, quite creative, eh?
-            thread_ts = file_data.get("shares")["private"][CHANNEL][0]["thread_ts"]
+def finish_replayed_event(job_id, ok):
+    """Saved event is gone only once its handler got through it"""
+    if ok:
+        checkpoints.remove(job_id)
+    else:
+        print(f"Replaying {job_id} failed, keeping it for the next process")
 
-            # Find that user and finally message them
-            for user in thread_manager.active_cache:
-                if thread_manager.active_cache[user]["thread_ts"] == thread_ts:
-                    send_dm_to_user(user, "", [file_data])
+def resume_jobs(jobs):
+    """Finish jobs some other process didn't manage to, whatever is left on shutdown stays saved"""
+    for job_id, job in jobs.items():
+        if shutdown.draining:
+            print(f"Shutting down, leaving the rest of the checkpointed jobs to the next process")
+            return
 
+        if job.get("type") == "delete_thread":
+            print(f"Resuming {job_id}")
+            delete_thread_job(job["user_id"], job["message_ts"], job["thread_ts"])
+        elif job.get("type") == "socket_event":
+            print(f"Replaying {job_id}")
+            try:
+                ok = handler.replay(job["event_type"], job["envelope_id"], job["payload"])
+            except Exception as err:
+                print(f"Error replaying {job_id}: {err}")
+                ok = False
+            finish_replayed_event(job_id, ok)
+        else:
+            print(f"Don't know how to resume {job_id}, dropping it")
+            checkpoints.remove(job_id)
+
+def resume_checkpointed_jobs(startup_jobs):
+    """Finish jobs claimed on startup, then keep picking up jobs of processes which went away later"""
+    # Don't hold shutdown up while threads are still loading
+    while not thread_manager.ready.wait(timeout=1):
+        if shutdown.draining:
+            return
 
-    except SlackApiError as err:
-        logger.error(f"Error handling file_shared event: {err}")
+    # Saved events already went through the startup buffer
+    resume_jobs({job_id: job for job_id, job in startup_jobs.items() if job.get("type") != "socket_event"})
 
+    # During a redeploy the old process is still alive when we start, its jobs only show up later
+    while not shutdown.draining:
+        time.sleep(CHECKPOINT_CLAIM_INTERVAL)
+        if shutdown.draining:
+            return
 
+        jobs = checkpoints.claim_orphans()
+        # Events came in before anything else there
+        resume_jobs(dict(sorted(jobs.items(), key=lambda item: item[1].get("type") != "socket_event")))
+
+bot_user_id = None
+
+
+def get_bot_user_id():
+    """User ID of the bot itself, asked once"""
+    global bot_user_id
+    if bot_user_id is None:
+        try:
+            bot_user_id = client.auth_test()["user_id"]
+        except SlackApiError as err:
+            print(f"Error getting bot user id: {err}")
+    return bot_user_id
+
+def relay_shared_file(file_id, event):
+    """
+    Relay a DM file no message event showed up for, needs the files.info call.
+    Files in the support channel only go out with their message event, which knows whether it's a note
+    """
+    user_id = event["user_id"]
+    if user_id == get_bot_user_id() or event.get("channel_id") == CHANNEL:
+        return
+
+    # Get that file info
+    file_data = client.files_info(file=file_id)["file"]
+
+    # Warning, warning - this is a DM! Nobody relayed it meanwhile, right?
+    if not file_data.get("ims") or not file_relay.claim([file_data]):
+        return
+
+    user_info = get_user_info(user_id)
+    if not user_info:
+        return
+
+    success = post_message_to_channel(user_id, "", user_info, [file_data])
+    if not success:
+        # Try to send an error message to the user, so he at least knows it failed...
+        try:
+            dm_response = client.conversations_open(users=user_id)
+            dm_channel = dm_response["channel"]["id"]
+            client.chat_postMessage(
+                channel=dm_channel,
+                username="Certpheus",
+                icon_url="https://hc-cdn.hel1.your-objectstorage.com/s/v3/1807d070b4fadf5884893855a00b542a1acc1aca_image.png",
+                text="*No luck for you, there was an issue processing your file*"
+            )
+
+        except SlackApiError as err:
+            print(f"Failed to send error msg: {err}")
+
+file_relay = FileRelay(relay_shared_file, coordinator.claim_file)
+memory_budget.register("file_relay", file_relay.size)
+
+
+@app.event("file_shared")
+def handle_file_shared(event, client, logger):
+    """Handle files being shared, usually the message event brings them first"""
+    file_relay.file_shared(event["file_id"], event)
 
 
 def format_file(files):
@@ -640,8 +1049,28 @@ def format_file(files):
 
     return "\n" + "\n".join(file_info)
 
+def upload_file_from_disk(file_obj, size, channel, thread_ts, filename, title):
+    """
+    files_upload_v2 reads the whole file into memory, so do its three steps by hand
+    and stream the bytes from disk. Returns the uploaded file, None if it failed
+    """
+    upload = client.files_getUploadURLExternal(filename=filename, length=size)
+
+    # requests sends a file object in chunks, it never reads it whole
+    response = requests.post(upload["upload_url"], data=file_obj)
+    if response.status_code != 200:
+        print(f"Failed to upload file {filename}: {response.status_code}")
+        return None
+
+    completed = client.files_completeUploadExternal(
+        files=[{"id": upload["file_id"], "title": title}],
+        channel_id=channel,
+        thread_ts=thread_ts
+    )
+    return completed["files"][0]
+
 def download_reupload_files(files, channel, thread_ts=None):
-    """Download files, then reupload them to the target channel"""
+    """Download files to disk, then reupload them to the target channel. Big files never sit in memory whole"""
     reuploaded = []
     for file in files:
         # Try downloading the file
@@ -653,27 +1082,31 @@ def download_reupload_files(files, channel, thread_ts=None):
                 continue
 
             headers = {'Authorization': f"Bearer {os.getenv('SLACK_BOT_TOKEN')}"}
-            response = requests.get(file_url, headers=headers)
-
-            # Upload that file!
-            if response.status_code == 200:
-                upload_params = {
-                    "channel": channel,
-                    "file": response.content,
-                    "filename": file.get("name", "file"),
-                    "title": file.get("title", file.get("name", "Some file without name?"))
-                }
-
-                if thread_ts:
-                    upload_params["thread_ts"] = thread_ts
-
-                upload_response = client.files_upload_v2(**upload_params)
+            with tempfile.TemporaryFile() as temp_file:
+                with requests.get(file_url, headers=headers, stream=True) as response:
+                    if response.status_code != 200:
+                        print(f"Failed to download file {file.get('name', 'unknown')}: {response.status_code}")
+                        continue
+
+                    for chunk in response.iter_content(chunk_size=FILE_CHUNK_BYTES):
+                        temp_file.write(chunk)
+
+                # Upload that file!
+                file_size = temp_file.tell()
+                temp_file.seek(0)
+                uploaded = upload_file_from_disk(
+                    temp_file,
+                    file_size,
+                    channel,
+                    thread_ts,
+                    file.get("name", "file"),
+                    file.get("title", file.get("name", "Some file without name?"))
+                )
 
-                # Awesome, file works - append it to the list
-                if upload_response.get("ok"):
-                    reuploaded.append(upload_response["file"])
-                else:
-                    print(f"Failed to reupload file: {upload_response.get('error')}")
+            # Awesome, file works - append it to the list, don't relay our own upload back
+            if uploaded:
+                reuploaded.append(uploaded)
+                file_relay.claim([uploaded])
 
         except Exception as err:
             print(f"Error processing file: {file.get('name', 'unknown'): {err}}")
@@ -692,6 +1125,36 @@ def error_handler(error, body, logger):
     logger.info(f"Request body: {body}")
 
 if __name__ == "__main__":
-    handler = SocketModeHandler(app, os.getenv("SLACK_APP_TOKEN"))
+    # Connect and load threads at the same time, events wait in a buffer until threads are there
+    handler = BufferedSocketModeHandler(
+        app,
+        os.getenv("SLACK_APP_TOKEN"),
+        thread_manager.ready,
+        max_buffered=int(os.getenv("STARTUP_BUFFER_SIZE") or "500"),
+        readiness_file=os.getenv("READINESS_FILE") or "/tmp/certpheus.ready"
+    )
+    memory_budget.register("startup_buffer", handler.buffer_size)
+    # Jobs of processes which are gone, ours now
+    saved_jobs = checkpoints.claim_orphans()
+    restore_saved_events(saved_jobs)
+    thread_manager.load_in_background()
+    thread_manager.start_activity_flusher()
+
+    # Own thread, not the pool - shutdown waits for the pool and this one runs for good
+    resumer = threading.Thread(target=resume_checkpointed_jobs, args=(saved_jobs,), name="checkpoints", daemon=True)
+    resumer.start()
+
+    # On SIGTERM: stop taking events, let the running ones finish, then write whatever is pending
+    shutdown.add_step("stop taking events", lambda time_left: handler.stop_accepting())
+    shutdown.add_step("startup buffer", drain_startup_buffer)
+    shutdown.add_step("in-flight handlers", listener_executor.wait_idle)
+    shutdown.add_step("pending files", lambda time_left: file_relay.flush())
+    shutdown.add_step("background work", executor.wait_idle)
+    shutdown.add_step("thread activity", lambda time_left: thread_manager.flush_activity())
+    shutdown.add_step("disconnect", lambda time_left: handler.close())
+    shutdown.install()
+
+    handler.connect()
     print("Bot running!")
-    handler.start()
+    shutdown.wait()
+    shutdown.run()
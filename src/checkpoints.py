@@ -0,0 +1,137 @@
+import glob
+import json
+import os
+import socket
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not on linux, nothing to tell live processes from dead ones
+    fcntl = None
+
+
+class CheckpointStore:
+    """
+    Small json files with unfinished jobs, so another process can pick them up.
+    Every process writes only its own file and keeps a lock on it while it's alive,
+    jobs of processes which are gone get claimed by whoever comes first
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.path = os.path.join(directory, f"{self.owner}.json")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._alive = None
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._alive = self._hold_lock()
+        except OSError as err:
+            print(f"Error setting up checkpoints in {directory}: {err}")
+
+    def _hold_lock(self):
+        # Locked before it shows up under its real name, so nobody ever sees it unlocked
+        lock_path = os.path.join(self.directory, f"{self.owner}.lock")
+        lock_file = open(f"{lock_path}.tmp", "w")
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(f"{lock_path}.tmp", lock_path)
+        return lock_file
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            print(f"Error reading checkpoints from {path}: {err}")
+            return {}
+
+    def _write(self):
+        # Write to a temp file first, half-written checkpoints are worse than none
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self._jobs, file)
+        os.replace(temp_path, self.path)
+
+    def save(self, job_id, data):
+        with self._lock:
+            self._jobs[job_id] = data
+            try:
+                self._write()
+            except OSError as err:
+                print(f"Error saving checkpoint {job_id}: {err}")
+
+    def remove(self, job_id):
+        with self._lock:
+            if self._jobs.pop(job_id, None) is None:
+                return
+            try:
+                self._write()
+            except OSError as err:
+                print(f"Error removing checkpoint {job_id}: {err}")
+
+    def all(self):
+        with self._lock:
+            return dict(self._jobs)
+
+    def claim_orphans(self):
+        """Take over jobs of processes which are gone, returns just the ones taken over now"""
+        claimed = {}
+        for lock_path in sorted(glob.glob(os.path.join(self.directory, "*.lock"))):
+            owner = os.path.basename(lock_path)[:-len(".lock")]
+            if owner == self.owner:
+                continue
+
+            try:
+                lock_fd = os.open(lock_path, os.O_RDWR)
+            except FileNotFoundError:
+                # Someone else claimed it meanwhile
+                continue
+
+            try:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Still alive, its jobs may be running right now
+                        continue
+
+                claimed.update(self._take_over(owner))
+                # The lock goes last, whoever opened it meanwhile finds nothing left to take
+                os.remove(lock_path)
+            except OSError as err:
+                print(f"Error claiming checkpoints of {owner}: {err}")
+            finally:
+                os.close(lock_fd)
+
+        return claimed
+
+    def _take_over(self, owner):
+        """Move jobs of a dead process into our file, we hold its lock"""
+        path = os.path.join(self.directory, f"{owner}.json")
+        claim_path = f"{path}.claimed"
+
+        # A claimer which died halfway left its claim behind, it's ours now too
+        jobs = self._read(claim_path)
+        if os.path.exists(path):
+            os.replace(path, claim_path)
+            jobs.update(self._read(claim_path))
+        if not jobs:
+            if os.path.exists(claim_path):
+                os.remove(claim_path)
+            return {}
+
+        with self._lock:
+            self._jobs.update(jobs)
+            self._write()
+        os.remove(claim_path)
+
+        print(f"Took over {len(jobs)} unfinished jobs of {owner}")
+        return jobs
@@ -0,0 +1,242 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from src.memory_budget import approx_size
+
+
+class LeaseError(TimeoutError):
+    """Couldn't get a lease - someone else kept it for too long, or the db failed"""
+
+
+class Coordinator:
+    """
+    Keeps replicas of the bot from stepping on each other.
+    Per-user leases make check-then-create of threads safe, invalidations tell other replicas
+    to drop what they cached about a user. Without a db path it only guards threads of this process
+    """
+
+    def __init__(self, db_path=None, lease_seconds=30, poll_interval=1.0):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local_locks = {}
+        self._local_locks_lock = threading.Lock()
+        self._connections = threading.local()
+        self._last_invalidation = 0
+        self._sync_lock = threading.Lock()
+        self._listener = None
+        self._callback = None
+
+        if self.db_path:
+            self._setup_db()
+
+    @property
+    def shared(self):
+        return bool(self.db_path)
+
+    def _db(self):
+        """One connection per thread, sqlite doesn't like sharing them"""
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._connections.connection = connection
+        return connection
+
+    def _setup_db(self):
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS invalidations "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, origin TEXT, created_at REAL)"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS file_claims (file_id TEXT PRIMARY KEY, claimed_at REAL)")
+        # Only what happens from now on matters to us
+        row = db.execute("SELECT MAX(id) FROM invalidations").fetchone()
+        self._last_invalidation = row[0] or 0
+
+    @contextmanager
+    def _local_lock(self, key, timeout):
+        """Lock for a key within this process, forgotten once nobody holds or waits for it"""
+        with self._local_locks_lock:
+            entry = self._local_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            if not entry[0].acquire(timeout=timeout):
+                raise LeaseError(f"Couldn't get local lock for {key}")
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._local_locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._local_locks[key]
+
+    def local_locks_size(self):
+        """Approximate memory used by local locks, for the memory budget"""
+        with self._local_locks_lock:
+            return approx_size(self._local_locks)
+
+    def _acquire_shared(self, key, timeout):
+        db = self._db()
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT owner, expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+                if row is None or row[1] < now or row[0] == self.owner:
+                    db.execute(
+                        "INSERT OR REPLACE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                        (key, self.owner, now + self.lease_seconds)
+                    )
+                    db.execute("COMMIT")
+                    return True
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+            if now >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def _release_shared(self, key):
+        try:
+            self._db().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
+        except sqlite3.Error as err:
+            # It expires on its own anyway
+            print(f"Error releasing lease {key}: {err}")
+
+    def _keep_renewing(self, key, stop):
+        """Push the expiry forward while we hold the lease, uploads can take longer than lease_seconds"""
+        def loop():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    cursor = self._db().execute(
+                        "UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?",
+                        (time.time() + self.lease_seconds, key, self.owner)
+                    )
+                    if cursor.rowcount == 0:
+                        print(f"Lost lease {key}, someone else has it now")
+                        return
+                except sqlite3.Error as err:
+                    print(f"Error renewing lease {key}: {err}")
+
+        renewer = threading.Thread(target=loop, name=f"lease-{key}", daemon=True)
+        renewer.start()
+        return renewer
+
+    @contextmanager
+    def lease(self, key, timeout=10):
+        """Hold a lease on a key, raises LeaseError if someone else keeps it for too long or the db fails"""
+        with self._local_lock(key, timeout):
+            if self.shared:
+                try:
+                    acquired = self._acquire_shared(key, timeout)
+                except sqlite3.Error as err:
+                    raise LeaseError(f"Couldn't get lease for {key}: {err}") from err
+                if not acquired:
+                    raise LeaseError(f"Couldn't get lease for {key}")
+
+                stop_renewing = threading.Event()
+                renewer = self._keep_renewing(key, stop_renewing)
+
+            try:
+                if self.shared:
+                    # Whatever the previous holder changed is visible to us before we look at the cache
+                    try:
+                        self.sync()
+                    except sqlite3.Error as err:
+                        raise LeaseError(f"Couldn't sync before using lease {key}: {err}") from err
+
+                yield
+            finally:
+                if self.shared:
+                    stop_renewing.set()
+                    renewer.join()
+                    self._release_shared(key)
+
+    @contextmanager
+    def user_lease(self, user_id, timeout=10):
+        with self.lease(f"user:{user_id}", timeout):
+            yield
+
+    def publish_invalidation(self, user_id):
+        """Tell other replicas that what they know about this user is stale"""
+        if not self.shared:
+            return
+
+        try:
+            self._db().execute(
+                "INSERT INTO invalidations (user_id, origin, created_at) VALUES (?, ?, ?)",
+                (user_id, self.owner, time.time())
+            )
+        except sqlite3.Error as err:
+            print(f"Error publishing invalidation for {user_id}: {err}")
+
+    def claim_file(self, file_id):
+        """
+        Only one replica gets to relay a file, the message event and file_shared often land on different ones.
+        True if we are the first to claim it
+        """
+        if not self.shared:
+            return True
+
+        cursor = self._db().execute(
+            "INSERT OR IGNORE INTO file_claims (file_id, claimed_at) VALUES (?, ?)",
+            (file_id, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def sync(self):
+        """Apply invalidations from other replicas right now"""
+        if not self.shared or not self._callback:
+            return
+
+        with self._sync_lock:
+            rows = self._db().execute(
+                "SELECT id, user_id, origin FROM invalidations WHERE id > ? ORDER BY id",
+                (self._last_invalidation,)
+            ).fetchall()
+
+            for invalidation_id, user_id, origin in rows:
+                self._last_invalidation = invalidation_id
+                if origin == self.owner:
+                    continue
+                try:
+                    self._callback(user_id)
+                except Exception as err:
+                    print(f"Error applying invalidation for {user_id}: {err}")
+
+    def listen(self, callback):
+        """Call callback(user_id) for every invalidation from other replicas"""
+        self._callback = callback
+        if not self.shared or self._listener:
+            return
+
+        def loop():
+            last_cleanup = 0
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    self.sync()
+
+                    # Old invalidations are useless, everyone has seen them by now
+                    if time.time() - last_cleanup > 3600:
+                        self._db().execute("DELETE FROM invalidations WHERE created_at < ?", (time.time() - 3600,))
+                        self._db().execute("DELETE FROM file_claims WHERE claimed_at < ?", (time.time() - 86400,))
+                        last_cleanup = time.time()
+                except sqlite3.Error as err:
+                    print(f"Error polling invalidations: {err}")
+
+        self._listener = threading.Thread(target=loop, name="coordination", daemon=True)
+        self._listener.start()
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+from src.memory_budget import approx_size
+
+
+class FileRelay:
+    """
+    Makes sure every file is relayed exactly once, no matter which event brings it first.
+    Message events carry full file info, so they claim files right away. file_shared only has the id,
+    so it waits a bit for the message event and only then falls back to fetching the file itself.
+    The fallback decides on its own whether the file should go anywhere, and claims it before relaying
+    """
+
+    def __init__(self, fallback_fn, shared_claim_fn=None, wait_seconds=3.0, remember_seconds=15 * 60):
+        self.fallback_fn = fallback_fn
+        self.shared_claim_fn = shared_claim_fn
+        self.wait_seconds = wait_seconds
+        self.remember_seconds = remember_seconds
+        self._seen = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _forget_old(self, now):
+        while self._seen:
+            file_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.remember_seconds:
+                break
+            self._seen.popitem(last=False)
+
+    def claim(self, files):
+        """Claim files from an event payload, returns only the ones nobody relayed yet"""
+        claimed = []
+        now = time.time()
+        with self._lock:
+            self._forget_old(now)
+            for file in files or []:
+                file_id = file.get("id")
+                if not file_id or file_id in self._seen:
+                    continue
+
+                self._seen[file_id] = now
+                timer = self._pending.pop(file_id, None)
+                if timer:
+                    timer.cancel()
+                claimed.append(file)
+
+        # Other replicas may have the other event for the same file
+        return [file for file in claimed if self._claim_shared(file["id"])]
+
+    def _claim_shared(self, file_id):
+        if not self.shared_claim_fn:
+            return True
+
+        try:
+            return self.shared_claim_fn(file_id)
+        except Exception as err:
+            # Relaying twice beats not relaying at all
+            print(f"Error claiming file {file_id} with other replicas: {err}")
+            return True
+
+    def file_shared(self, file_id, event):
+        """file_shared came in, give the message event some time before doing it the slow way"""
+        with self._lock:
+            if file_id in self._seen or file_id in self._pending:
+                return
+
+            timer = threading.Timer(self.wait_seconds, self._run_fallback, args=(file_id, event))
+            timer.daemon = True
+            self._pending[file_id] = timer
+
+        timer.start()
+
+    def flush(self):
+        """Don't wait for message events anymore, relay everything pending right now"""
+        with self._lock:
+            pending = list(self._pending.items())
+
+        for file_id, timer in pending:
+            timer.cancel()
+            self._run_fallback(file_id, timer.args[1])
+
+    def _run_fallback(self, file_id, event):
+        with self._lock:
+            if self._pending.pop(file_id, None) is None or file_id in self._seen:
+                return
+
+        try:
+            self.fallback_fn(file_id, event)
+        except Exception as err:
+            print(f"Error relaying file {file_id}: {err}")
+
+    def size(self):
+        """Approximate memory used, for the memory budget"""
+        with self._lock:
+            return approx_size(self._seen) + approx_size(self._pending)
@@ -0,0 +1,151 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def approx_size(obj, seen=None):
+    """Rough deep size of an object in bytes, good enough for dicts/lists of strings"""
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            size += approx_size(key, seen) + approx_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in list(obj):
+            size += approx_size(item, seen)
+
+    return size
+
+def get_rss_bytes():
+    """Resident memory of this process, None if we can't tell (not on linux)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class MemoryBudget:
+    """Keeps all in-process caches and queues under one memory ceiling"""
+
+    def __init__(self, limit_bytes, rss_limit_bytes=None, high_water=0.9, rss_regrowth=0.05, check_interval=30):
+        self.limit_bytes = limit_bytes
+        self.rss_limit_bytes = rss_limit_bytes
+        self.high_water = high_water
+        self.rss_regrowth = rss_regrowth
+        self._rss_evicted_at = None
+        self.check_interval = check_interval
+        self._components = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, name, size_fn, evict_fn=None, priority=0):
+        """
+        Register a cache or a queue.
+        size_fn() returns its approximate size in bytes, evict_fn(bytes_to_free) frees some of it
+        and returns how much was freed. Lower priority gets evicted first, no evict_fn means it's only reported
+        """
+        with self._lock:
+            self._components[name] = {
+                "size_fn": size_fn,
+                "evict_fn": evict_fn,
+                "priority": priority
+            }
+
+    def usage(self):
+        """Approximate size of every registered component"""
+        with self._lock:
+            components = dict(self._components)
+
+        usage = {}
+        for name, component in components.items():
+            try:
+                usage[name] = component["size_fn"]()
+            except Exception as err:
+                print(f"Error measuring {name}: {err}")
+                usage[name] = 0
+
+        return usage
+
+    def total(self):
+        return sum(self.usage().values())
+
+    def enforce(self):
+        """Evict stuff in priority order if we are over the high water mark, either with our caches or with the whole process"""
+        ceiling = int(self.limit_bytes * self.high_water)
+        to_free_total = self.total() - ceiling
+
+        # Caches may look small while the process is not, RSS is what gets us killed
+        rss = get_rss_bytes()
+        if rss is not None and self.rss_limit_bytes:
+            rss_ceiling = int(self.rss_limit_bytes * self.high_water)
+            if rss <= rss_ceiling:
+                self._rss_evicted_at = None
+            elif self._rss_evicted_at is None or rss - self._rss_evicted_at > self.rss_limit_bytes * self.rss_regrowth:
+                # RSS rarely goes down after a big allocation, evicting again only helps if it keeps growing
+                to_free_total = max(to_free_total, rss - rss_ceiling)
+                self._rss_evicted_at = rss
+
+        if to_free_total <= 0:
+            return 0
+
+        with self._lock:
+            evictable = sorted(
+                ((name, c) for name, c in self._components.items() if c["evict_fn"]),
+                key=lambda item: item[1]["priority"]
+            )
+
+        freed = 0
+        for name, component in evictable:
+            to_free = to_free_total - freed
+            if to_free <= 0:
+                break
+
+            try:
+                released = component["evict_fn"](to_free) or 0
+                freed += released
+                print(f"Memory budget: evicted ~{released} bytes from {name}")
+            except Exception as err:
+                print(f"Error evicting from {name}: {err}")
+
+        return freed
+
+    def snapshot(self, top_n=10):
+        """
+        Top allocation sites. The first call turns tracing on, the next one takes the snapshot
+        and turns it off again - tracing costs memory and CPU we don't have
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return None
+
+        try:
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+        finally:
+            tracemalloc.stop()
+        return [(str(stat.traceback), stat.size, stat.count) for stat in stats[:top_n]]
+
+    def start(self):
+        """Check the budget periodically in a background thread"""
+        if self._thread:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.check_interval)
+                try:
+                    self.enforce()
+                except Exception as err:
+                    print(f"Error enforcing memory budget: {err}")
+
+        self._thread = threading.Thread(target=loop, name="memory-budget", daemon=True)
+        self._thread.start()
@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TrackedExecutor(ThreadPoolExecutor):
+    """Thread pool which knows how much work it still has, so shutdown can wait for it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._unfinished = 0
+        self._idle = threading.Condition()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._idle:
+            self._unfinished += 1
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._idle:
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._idle.notify_all()
+
+    @property
+    def unfinished(self):
+        return self._unfinished
+
+    def wait_idle(self, timeout):
+        """Wait until nothing is running or queued, False if time ran out"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout=timeout)
+
+
+# One pool for everything, Slack and Airtable calls are mostly waiting on network anyway
+executor = TrackedExecutor(max_workers=16, thread_name_prefix="certpheus")
+
+# Bolt runs listeners here, kept apart so listeners waiting on steps above can't starve them
+listener_executor = TrackedExecutor(max_workers=10, thread_name_prefix="certpheus-listener")
+
+
+class StepResult:
+    """Outcome of a single step, either a value or an error"""
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def run_parallel(**steps):
+    """
+    Run independent steps at the same time and wait for all of them.
+    Every step is a function without arguments, returns {step name: StepResult}
+    """
+    futures = {name: executor.submit(step) for name, step in steps.items()}
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = StepResult(value=future.result())
+        except Exception as err:
+            print(f"Step {name} failed: {err}")
+            results[name] = StepResult(error=err)
+
+    return results
+
+def run_in_background(step, name="background step"):
+    """Fire and forget, errors only get printed"""
+    def wrapped():
+        try:
+            return step()
+        except Exception as err:
+            print(f"Error in {name}: {err}")
+
+    return executor.submit(wrapped)
+
+# Rough size of a queued work item with its future and closure
+WORK_ITEM_BYTES = 512
+
+
+def queue_bytes(pool=executor):
+    """Approximate size of steps waiting for a free worker, for the memory budget"""
+    return pool._work_queue.qsize() * WORK_ITEM_BYTES
@@ -0,0 +1,54 @@
+import signal
+import threading
+import time
+
+
+class ShutdownCoordinator:
+    """
+    Drains the bot on SIGTERM instead of just dying.
+    Steps run in the order they were added, each gets whatever is left of the deadline
+    """
+
+    def __init__(self, deadline_seconds=25):
+        self.deadline_seconds = deadline_seconds
+        self._requested = threading.Event()
+        self._steps = []
+
+    @property
+    def draining(self):
+        """Long jobs should check this and stop at a safe point"""
+        return self._requested.is_set()
+
+    def add_step(self, name, step):
+        """step(time_left) gets called during shutdown, returning False means it didn't finish"""
+        self._steps.append((name, step))
+
+    def install(self):
+        """Catch SIGTERM and SIGINT, has to be called from the main thread"""
+        def on_signal(signum, frame):
+            print(f"Got signal {signum}, shutting down")
+            self._requested.set()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+    def wait(self):
+        """Block until someone asks us to shut down"""
+        while not self._requested.wait(timeout=1):
+            pass
+
+    def run(self):
+        """Go through all the steps within the deadline"""
+        self._requested.set()
+        deadline = time.time() + self.deadline_seconds
+
+        for name, step in self._steps:
+            time_left = max(deadline - time.time(), 0)
+            try:
+                finished = step(time_left)
+                if finished is False:
+                    print(f"Shutdown step {name} didn't finish in time")
+            except Exception as err:
+                print(f"Error in shutdown step {name}: {err}")
+
+        print("Shutdown complete")
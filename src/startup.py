@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import deque
+
+from src.memory_budget import approx_size
+
+from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_bolt.adapter.socket_mode.internals import run_bolt_app
+from slack_bolt.listener.thread_runner import ThreadListenerRunner
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+
+
+class SerialListenerRunner(ThreadListenerRunner):
+    """
+    Bolt's listener runner, except dispatches made through run_serially() wait for the listener to finish.
+    Normally events are acked and their listener goes to the pool, so buffered ones would all run at once
+    """
+
+    def __init__(self, runner):
+        super().__init__(
+            logger=runner.logger,
+            process_before_response=runner.process_before_response,
+            listener_error_handler=runner.listener_error_handler,
+            listener_start_handler=runner.listener_start_handler,
+            listener_completion_handler=runner.listener_completion_handler,
+            listener_executor=runner.listener_executor,
+            lazy_listener_runner=runner.lazy_listener_runner
+        )
+
+    @property
+    def process_before_response(self):
+        return getattr(self._serial, "enabled", False) or self._process_before_response
+
+    @process_before_response.setter
+    def process_before_response(self, value):
+        self._serial = threading.local()
+        self._process_before_response = value
+
+    def run_serially(self, app, req):
+        """Dispatch in this thread and return once the listener is done, True if it didn't fail"""
+        self._serial.enabled = True
+        try:
+            response = run_bolt_app(app, req)
+        finally:
+            self._serial.enabled = False
+        return response is not None and response.status < 500
+
+
+class BufferedSocketModeHandler(SocketModeHandler):
+    """
+    Socket Mode handler which connects right away, even before the state is loaded.
+    Events coming in before that are acked and kept in a bounded buffer, then handled in order once ready.
+    When the buffer is full events don't get acked, so Slack sends them again later
+    """
+
+    def __init__(self, app, app_token, ready, max_buffered=500, readiness_file=None, **kwargs):
+        super().__init__(app, app_token, **kwargs)
+        # Bolt has no way to pass a runner in, so swap it - it still runs everything else as before
+        self.runner = SerialListenerRunner(app.listener_runner)
+        app._listener_runner = self.runner
+        self.ready = ready
+        self.max_buffered = max_buffered
+        self.readiness_file = readiness_file
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._open = False
+        self._accepting = True
+        self._drained = threading.Event()
+        self.metrics = {
+            "buffered": 0,
+            "dropped": 0,
+            "max_wait": 0.0,
+            "total_wait": 0.0,
+            "ready_after": None
+        }
+        self._started_at = time.time()
+        if self.readiness_file and os.path.exists(self.readiness_file):
+            os.remove(self.readiness_file)
+        self._drainer = threading.Thread(target=self._drain, name="startup-drain", daemon=True)
+        self._drainer.start()
+
+    @property
+    def is_ready(self):
+        return self._open
+
+    def buffer_size(self):
+        """Approximate memory used by buffered events, for the memory budget"""
+        with self._lock:
+            return approx_size([req.payload for req, buffered_at, on_done in self._buffer])
+
+    def stop_accepting(self):
+        """Shutting down - new events stay unacked, Slack will deliver them to someone else later"""
+        with self._lock:
+            self._accepting = False
+
+    def wait_drained(self, timeout):
+        """Buffered events were acked already and Slack won't resend them, give them a chance to run"""
+        return self._drained.wait(timeout)
+
+    def take_buffered(self):
+        """Whatever is still buffered, to be saved for the next process. The drain stops afterwards"""
+        with self._lock:
+            leftover = [req for req, buffered_at, on_done in self._buffer]
+            self._buffer.clear()
+        return leftover
+
+    def restore(self, event_type, envelope_id, payload, buffered_at=None, on_done=None):
+        """
+        Put an event saved by a previous process in front of the buffer, it came before anything we got.
+        Has to happen before the drain starts, on_done(ok) gets called once its listener finished
+        """
+        req = SocketModeRequest(type=event_type, envelope_id=envelope_id, payload=payload)
+        with self._lock:
+            if self._open:
+                raise RuntimeError("Startup buffer is already drained")
+
+            # Saved events keep their order, ahead of whatever got buffered meanwhile
+            restored = sum(1 for entry in self._buffer if entry[2] is not None)
+            self._buffer.insert(restored, (req, buffered_at or time.time(), on_done))
+            self.metrics["buffered"] += 1
+
+    def replay(self, event_type, envelope_id, payload):
+        """Handle an event saved by a previous process right now, True once its listener finished fine"""
+        req = SocketModeRequest(type=event_type, envelope_id=envelope_id, payload=payload)
+        return self.runner.run_serially(self.app, req)
+
+    def handle(self, client, req):
+        with self._lock:
+            if not self._accepting:
+                return
+
+            if not self._open:
+                if len(self._buffer) >= self.max_buffered:
+                    self.metrics["dropped"] += 1
+                    print(f"Startup buffer is full, letting Slack retry {req.envelope_id}")
+                    return
+
+                # Ack now, Slack won't wait for us to load everything
+                client.send_socket_mode_response(SocketModeResponse(envelope_id=req.envelope_id))
+                self._buffer.append((req, time.time(), None))
+                self.metrics["buffered"] += 1
+                return
+
+        super().handle(client, req)
+
+    def _drain(self):
+        """Wait for the state, then handle everything buffered in the order it came"""
+        self.ready.wait()
+        self.metrics["ready_after"] = time.time() - self._started_at
+
+        while True:
+            with self._lock:
+                if not self._buffer:
+                    # Nothing left and the last one already ran, from now on events go straight through
+                    self._open = True
+                    self._drained.set()
+                    break
+                req, buffered_at, on_done = self._buffer.popleft()
+
+            # One at a time, the next one starts only after this listener is done
+            try:
+                # The envelope was acked already, the response has nowhere to go
+                ok = self.runner.run_serially(self.app, req)
+            except Exception as err:
+                print(f"Error handling buffered event {req.envelope_id}: {err}")
+                ok = False
+
+            # Buffered time is until the event got handled, not just until it left the buffer
+            waited = time.time() - buffered_at
+            self.metrics["max_wait"] = max(self.metrics["max_wait"], waited)
+            self.metrics["total_wait"] += waited
+
+            if on_done:
+                try:
+                    on_done(ok)
+                except Exception as err:
+                    print(f"Error finishing buffered event {req.envelope_id}: {err}")
+
+        buffered = self.metrics["buffered"]
+        average_wait = self.metrics["total_wait"] / buffered if buffered else 0
+        print(
+            f"Bot ready after {self.metrics['ready_after']:.1f}s, {buffered} events were buffered "
+            f"(avg wait {average_wait:.1f}s, max {self.metrics['max_wait']:.1f}s, dropped {self.metrics['dropped']})"
+        )
+
+        if self.readiness_file:
+            try:
+                with open(self.readiness_file, "w") as file:
+                    file.write(str(time.time()))
+            except OSError as err:
+                print(f"Couldn't write readiness file: {err}")
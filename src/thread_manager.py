@@ -1,16 +1,45 @@
+import bisect
+import threading
+import time
 from datetime import datetime
 
+from src.memory_budget import approx_size
+from src.thread_stats import ThreadStats, today
+
+
+def thread_sort_key(thread):
+    """Threads are ordered by their ts, which is just the time they were created"""
+    try:
+        return float(thread.get("thread_ts") or 0)
+    except ValueError:
+        return 0.0
+
 
 class ThreadManager:
     """Manages threads with the help of Airtable"""
 
-    def __init__(self, airtable_base):
+    def __init__(self, airtable_base, coordinator=None, load=True):
         self._active_cache = {}
         self._completed_cache = {}
+        self._evicted_users = set()
+        self.stats = ThreadStats(lambda: len(self._active_cache))
+        self.coordinator = coordinator
         self.active_threads_table = airtable_base.table("Active Threads")
         self.completed_threads_table = airtable_base.table("Completed Threads")
+        self.ready = threading.Event()
+        self._deferred_refreshes = set()
+        self._refresh_lock = threading.Lock()
+        self._pending_activity = {}
+        self._pending_activity_lock = threading.Lock()
+
+        if load:
+            self._load_from_airtable()
 
-        self._load_from_airtable()
+    def load_in_background(self):
+        """Load threads without blocking, wait for self.ready to know when it's done"""
+        loader = threading.Thread(target=self._load_from_airtable, name="thread-manager-load", daemon=True)
+        loader.start()
+        return loader
 
     def _load_from_airtable(self):
         """Load existing threads from Airtable"""
@@ -27,6 +56,7 @@ class ThreadManager:
                         "message_ts": fields.get("message_ts"),
                         "record_id": record["id"]
                     }
+                    self.stats.thread_created(user_id, fields.get("thread_ts"), awaiting_response=False)
 
             # Load completed threads
             completed_records = self.completed_threads_table.all()
@@ -36,18 +66,45 @@ class ThreadManager:
                 if user_id:
                     if user_id not in self._completed_cache:
                         self._completed_cache[user_id] = []
-                    self._completed_cache[user_id].append({
-                        "thread_ts": fields.get("thread_ts"),
-                        "channel": fields.get("channel"),
-                        "message_ts": fields.get("message_ts"),
-                        "record_id": record["id"]
-                    })
+                    thread = self._completed_entry(record)
+                    self._completed_cache[user_id].append(thread)
+                    self.stats.completed_thread_loaded(user_id, thread["completed_at"])
+
+            # Completed threads of every user are kept ordered by time, oldest first
+            for threads in self._completed_cache.values():
+                threads.sort(key=thread_sort_key)
+
             completed_threads_count = sum(len(threads) for threads in self._completed_cache.values())
             print(f"Loaded {len(self._active_cache)} active and {completed_threads_count} completed threads from db")
 
         except Exception as err:
             print(f"Error loading threads from Airtable: {err}")
 
+        # Other replicas changed some users while we were loading, our snapshot of them may be older
+        while True:
+            with self._refresh_lock:
+                if not self._deferred_refreshes:
+                    # Even after an error, carry on the way we always did - with whatever got loaded
+                    self.ready.set()
+                    break
+                deferred = self._deferred_refreshes
+                self._deferred_refreshes = set()
+
+            for user_id in deferred:
+                self._refresh_user_now(user_id)
+
+    @staticmethod
+    def _completed_entry(record):
+        """Cache entry of a completed thread record"""
+        fields = record["fields"]
+        return {
+            "thread_ts": fields.get("thread_ts"),
+            "channel": fields.get("channel"),
+            "message_ts": fields.get("message_ts"),
+            "completed_at": (fields.get("completed_at") or "")[:10] or None,
+            "record_id": record["id"]
+        }
+
     def get_active_thread(self, user_id):
         """Get active thread for a user"""
         return self._active_cache.get(user_id)
@@ -56,8 +113,8 @@ class ThreadManager:
         """Does user have an existing thread"""
         return user_id in self._active_cache
 
-    def create_active_thread(self, user_id, channel, thread_ts, message_ts):
-        """Create new active thread"""
+    def create_active_thread(self, user_id, channel, thread_ts, message_ts, awaiting_response=True):
+        """Create new active thread, awaiting_response is False for threads started by staff"""
         try:
             record = self.active_threads_table.create({
                 "user_id": user_id,
@@ -76,6 +133,8 @@ class ThreadManager:
             if user_id not in self._completed_cache:
                 self._completed_cache[user_id] = []
 
+            self.stats.thread_created(user_id, thread_ts, awaiting_response)
+            self._publish_change(user_id)
             print(f"Created active thread for user {user_id}")
             return True
 
@@ -84,17 +143,65 @@ class ThreadManager:
             return False
 
     def update_thread_activity(self, user_id):
-        """Updated last activity ts for a thread, if cached"""
-        if user_id not in self._active_cache:
+        """Updated last activity ts for a thread, if cached. It gets written with the next flush"""
+        thread_info = self._active_cache.get(user_id)
+        if not thread_info:
             return
 
+        with self._pending_activity_lock:
+            self._pending_activity[thread_info["record_id"]] = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
+
+    def flush_activity(self):
+        """Write all pending activity timestamps, Airtable takes 10 records per request"""
+        with self._pending_activity_lock:
+            pending = self._pending_activity
+            self._pending_activity = {}
+
+        if not pending:
+            return True
+
+        # Threads completed or deleted meanwhile don't have a record anymore
+        active_records = {thread["record_id"] for thread in list(self._active_cache.values())}
+        updates = [
+            {"id": record_id, "fields": {"funny_field": activity}}
+            for record_id, activity in pending.items()
+            if record_id in active_records
+        ]
+
         try:
-            record_id = self._active_cache[user_id]["record_id"]
-            self.active_threads_table.update(record_id, {
-                "funny_field": datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-            })
+            if updates:
+                self.active_threads_table.batch_update(updates)
+            return True
         except Exception as err:
             print(f"Error updating thread activity ts: {err}")
+            # Put them back for the next flush, unless something newer came in meanwhile
+            with self._pending_activity_lock:
+                for record_id, activity in pending.items():
+                    self._pending_activity.setdefault(record_id, activity)
+            return False
+
+    def pending_activity_size(self):
+        return approx_size(self._pending_activity)
+
+    def start_activity_flusher(self, interval=30):
+        """Flush activity timestamps every now and then in the background"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.flush_activity()
+
+        flusher = threading.Thread(target=loop, name="activity-flusher", daemon=True)
+        flusher.start()
+        return flusher
+
+    def record_staff_reply(self, thread_ts):
+        """Staff answered in a thread, only threads still waiting for their first response count"""
+        self.stats.staff_replied(thread_ts)
+
+    def is_active_thread(self, user_id, thread_ts):
+        """Is this thread the user's current active one (and not some older one)"""
+        thread_info = self._active_cache.get(user_id)
+        return bool(thread_info) and thread_info["thread_ts"] == thread_ts
 
     def complete_thread(self, user_id):
         """Mark active thread as completed"""
@@ -114,15 +221,19 @@ class ThreadManager:
             self.active_threads_table.delete(active_thread["record_id"])
 
             # Update cache
+            self._ensure_completed_loaded(user_id)
             if user_id not in self._completed_cache:
                 self._completed_cache[user_id] = []
-            self._completed_cache[user_id].append({
+            bisect.insort(self._completed_cache[user_id], {
                 "thread_ts": active_thread["thread_ts"],
                 "channel": active_thread["channel"],
                 "message_ts": active_thread["message_ts"],
+                "completed_at": today(),
                 "record_id": completed_record["id"]
-            })
+            }, key=thread_sort_key)
             del self._active_cache[user_id]
+            self.stats.thread_completed(active_thread["thread_ts"])
+            self._publish_change(user_id)
 
             print(f"Completed thread for user {user_id}")
             return True
@@ -131,10 +242,121 @@ class ThreadManager:
             print(f"Error completing thread: {err}")
             return False
 
+    def _publish_change(self, user_id):
+        """Let other replicas know our view of this user changed"""
+        if self.coordinator:
+            self.coordinator.publish_invalidation(user_id)
+
+    def refresh_user(self, user_id):
+        """Another replica changed this user's threads. While loading it waits, the load would overwrite it"""
+        with self._refresh_lock:
+            if not self.ready.is_set():
+                self._deferred_refreshes.add(user_id)
+                return
+
+        self._refresh_user_now(user_id)
+
+    def _refresh_user_now(self, user_id):
+        """Reload user's active thread and drop the completed ones"""
+        try:
+            records = self.active_threads_table.all(formula=f"{{user_id}} = '{user_id}'")
+            previous = self._active_cache.get(user_id)
+            if previous and (not records or records[0]["fields"].get("thread_ts") != previous["thread_ts"]):
+                self.stats.thread_closed_elsewhere(previous["thread_ts"])
+
+            if records:
+                fields = records[0]["fields"]
+                self._active_cache[user_id] = {
+                    "thread_ts": fields.get("thread_ts"),
+                    "channel": fields.get("channel"),
+                    "message_ts": fields.get("message_ts"),
+                    "record_id": records[0]["id"]
+                }
+            else:
+                self._active_cache.pop(user_id, None)
+
+            # Completed ones come back lazily next time someone asks
+            self._completed_cache.pop(user_id, None)
+            self._evicted_users.add(user_id)
+        except Exception as err:
+            print(f"Error refreshing threads of {user_id}: {err}")
+
+    def find_user_by_thread(self, thread_ts):
+        """Find the owner of an active thread by its ts, used for threads without metadata"""
+        for user_id, thread_info in self._active_cache.items():
+            if thread_info["thread_ts"] == thread_ts:
+                return user_id
+
+        return None
+
     def get_completed_threads(self, user_id):
         """Get completed threads of a user"""
+        self._ensure_completed_loaded(user_id)
         return self._completed_cache.get(user_id, [])
 
+    def get_user_history(self, user_id, page=1, page_size=10):
+        """
+        One page of user's threads, newest first - active thread (if any) goes on top.
+        Returns (threads, total count), each thread has an extra "active" flag
+        """
+        self._ensure_completed_loaded(user_id)
+        completed = self._completed_cache.get(user_id, [])
+        active = self._active_cache.get(user_id)
+
+        history_size = len(completed) + (1 if active else 0)
+        start = (max(page, 1) - 1) * page_size
+        end = min(start + page_size, history_size)
+
+        threads = []
+        for position in range(start, end):
+            if active and position == 0:
+                threads.append({**active, "active": True})
+                continue
+
+            # Completed threads are stored oldest first, walk them from the end
+            index = len(completed) - 1 - (position - (1 if active else 0))
+            threads.append({**completed[index], "active": False})
+
+        return threads, history_size
+
+    def _ensure_completed_loaded(self, user_id):
+        """Bring back completed threads of a user that got evicted from memory"""
+        if user_id not in self._evicted_users:
+            return
+
+        try:
+            records = self.completed_threads_table.all(formula=f"{{user_id}} = '{user_id}'")
+            threads = [self._completed_entry(record) for record in records]
+            threads.sort(key=thread_sort_key)
+            self._completed_cache[user_id] = threads
+            self._evicted_users.discard(user_id)
+        except Exception as err:
+            print(f"Error loading completed threads of {user_id}: {err}")
+
+    def active_cache_size(self):
+        return approx_size(self._active_cache)
+
+    def completed_cache_size(self):
+        return approx_size(self._completed_cache)
+
+    def evict_completed(self, bytes_to_free):
+        """Drop completed threads of users without an active thread, they get reloaded on demand"""
+        freed = 0
+        for user_id in list(self._completed_cache):
+            if freed >= bytes_to_free:
+                break
+            if user_id in self._active_cache:
+                continue
+
+            threads = self._completed_cache.pop(user_id, None)
+            if threads is None:
+                continue
+
+            freed += approx_size(user_id) + approx_size(threads)
+            self._evicted_users.add(user_id)
+
+        return freed
+
     def delete_thread(self, user_id, message_ts):
         """Delete thread, either active or completed - doesn't matter"""
         try:
@@ -143,11 +365,14 @@ class ThreadManager:
                 record_id = self._active_cache[user_id]["record_id"]
 
                 self.active_threads_table.delete(record_id)
-                del self._active_cache[user_id]
+                removed_thread = self._active_cache.pop(user_id)
+                self.stats.thread_deleted(user_id, removed_thread["thread_ts"])
+                self._publish_change(user_id)
                 print(f"Deleted active thread for {user_id}")
                 return self._active_cache.get(user_id)
 
             # Now look for completed thread with this ts, delete it if possible
+            self._ensure_completed_loaded(user_id)
             if user_id in self._completed_cache:
                 for i, thread in enumerate(self._completed_cache[user_id]):
                     if thread["message_ts"] == message_ts:
@@ -155,6 +380,13 @@ class ThreadManager:
 
                         self.completed_threads_table.delete(record_id)
                         removed_thread = self._completed_cache[user_id].pop(i)
+                        self.stats.thread_deleted(
+                            user_id,
+                            removed_thread["thread_ts"],
+                            completed_day=removed_thread.get("completed_at"),
+                            was_active=False
+                        )
+                        self._publish_change(user_id)
                         print(f"Deleted finished thread of {user_id}")
                         return removed_thread, False
 
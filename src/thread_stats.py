@@ -0,0 +1,103 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+
+# Upper bounds of first response time buckets, in seconds
+RESPONSE_BUCKETS = [60, 5 * 60, 15 * 60, 30 * 60, 60 * 60, 2 * 3600, 4 * 3600, 8 * 3600, 24 * 3600, 48 * 3600, 7 * 24 * 3600]
+
+
+def today():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class ThreadStats:
+    """Rolling aggregates about threads, every update is O(1) so asking for them is free"""
+
+    def __init__(self, open_threads_fn=lambda: 0):
+        self._lock = threading.Lock()
+        # Open threads come straight from the active cache, other replicas keep that one up to date
+        self.open_threads_fn = open_threads_fn
+        self.response_histogram = [0] * (len(RESPONSE_BUCKETS) + 1)
+        self.completed_per_day = Counter()
+        self.threads_per_user = Counter()
+        self._awaiting_response = {}
+
+    def thread_created(self, user_id, thread_ts, awaiting_response=True):
+        """New active thread, started by the user unless said otherwise"""
+        with self._lock:
+            self.threads_per_user[user_id] += 1
+            if awaiting_response and thread_ts:
+                self._awaiting_response[thread_ts] = float(thread_ts)
+
+    def staff_replied(self, thread_ts):
+        """Staff answered in a thread, only the first answer counts"""
+        with self._lock:
+            started = self._awaiting_response.pop(thread_ts, None)
+            if started is None:
+                return
+
+            waited = max(time.time() - started, 0)
+            self.response_histogram[bisect.bisect_left(RESPONSE_BUCKETS, waited)] += 1
+
+    def thread_completed(self, thread_ts, day=None):
+        """Active thread got marked as completed"""
+        with self._lock:
+            self.completed_per_day[day or today()] += 1
+            self._awaiting_response.pop(thread_ts, None)
+
+    def completed_thread_loaded(self, user_id, day):
+        """Completed thread from the db"""
+        with self._lock:
+            self.threads_per_user[user_id] += 1
+            if day:
+                self.completed_per_day[day] += 1
+
+    def thread_deleted(self, user_id, thread_ts, completed_day=None, was_active=True):
+        """Thread got deleted, take it out of every aggregate"""
+        with self._lock:
+            self.threads_per_user[user_id] -= 1
+            if self.threads_per_user[user_id] <= 0:
+                del self.threads_per_user[user_id]
+
+            if was_active:
+                self._awaiting_response.pop(thread_ts, None)
+            elif completed_day and self.completed_per_day[completed_day] > 0:
+                self.completed_per_day[completed_day] -= 1
+
+    def thread_closed_elsewhere(self, thread_ts):
+        """Another replica completed or deleted a thread, nobody is waiting on it anymore"""
+        with self._lock:
+            self._awaiting_response.pop(thread_ts, None)
+
+    def median_response_bucket(self):
+        """Upper bound of the bucket holding the median first response time, None without data"""
+        with self._lock:
+            total = sum(self.response_histogram)
+            if total == 0:
+                return None
+
+            seen = 0
+            for i, count in enumerate(self.response_histogram):
+                seen += count
+                if seen * 2 >= total:
+                    return RESPONSE_BUCKETS[i] if i < len(RESPONSE_BUCKETS) else float("inf")
+
+    def summary(self, days=7, top_users=5):
+        """Everything /certstats needs"""
+        median = self.median_response_bucket()
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            return {
+                "open_threads": self.open_threads_fn(),
+                "awaiting_response": len(self._awaiting_response),
+                "responses_measured": sum(self.response_histogram),
+                "median_response": median,
+                "completed_per_day": [
+                    (day, self.completed_per_day.get(day, 0))
+                    for day in ((now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days))
+                ],
+                "busiest_users": self.threads_per_user.most_common(top_users)
+            }